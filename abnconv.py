@@ -2,175 +2,176 @@ from __future__ import absolute_import, print_function
 
 import argparse
 import configparser
-import datetime
+import io
 import os
 import re
-import shutil
-import tempfile
-import xml.etree.ElementTree
 import zipfile
+from types import TracebackType
+from typing import IO, Dict, Iterable, Iterator, List, Match, Optional, Set, Tuple, Type, Union, cast
 
-ns = {'xmlns': "urn:iso:std:iso:20022:tech:xsd:camt.053.001.02"}
+import lxml.etree as ET
 
-BEA_re = re.compile("(?P<subtype>[GB])EA.+(\d{2}.){4}\d{2}(?P<payee>.+),PAS(\d+)")
+Q = "{urn:iso:std:iso:20022:tech:xsd:camt.053.001.02}"
 
-SEPA_re = re.compile("/TRTP/.+")
-SEPA_markers_re = re.compile("/(TRTP|CSID|NAME|MARF|REMI|IBAN|BIC|EREF)/")
+IBAN_tag = Q + "IBAN"
+NTRY_tag = Q + "Ntry"
+VALDT_path = Q + "ValDt/" + Q + "Dt"
+AMT_path = Q + "Amt"
+CDTDBTIND_path = Q + "CdtDbtInd"
+ADDTLNTRYINF_path = Q + "AddtlNtryInf"
 
-ABN_re = re.compile("(?P<payee>ABN AMRO Bank N.V.)\s+(?P<memo>\w+).+")
+BUFFER_SIZE = 1 << 20
 
-SPAREN_re = re.compile("ACCOUNT BALANCED\s+(?P<memo>CREDIT INTEREST.+)For interest rates")
+# raw fields of a statement entry: account, value date, amount, credit/debit indicator and description
+RawEntry = Tuple[str, str, str, str, str]
 
-STORTING_re = re.compile("STORTING\s+.+,PAS (\d+)")
+# dedup key of a transaction: source, destination, type, YYYYMMDD date, amount, payee and memo
+TrsxKey = Tuple[str, Optional[str], Optional[str], str, float, Optional[str], Optional[str]]
 
-SUPPORTED_TRANSACTIONS = {
-    'bea': BEA_re,
-    'sepa': SEPA_re,
-    'abn': ABN_re,
-    'sparen': SPAREN_re,
-    'storting': STORTING_re
-}
+BEA_re = re.compile(r"(?P<subtype>[GB])EA.+(?:\d{2}.){4}\d{2}(?P<payee>.+),PAS\d+")
 
-qif_account_tpl = """!Account
-N{name}
-T{type}
-^"""
+# a transaction type must follow the marker; the literal prefix lets re skip straight to it
+SEPA_re = re.compile(r"/TRTP/.")
+SEPA_markers_re = re.compile(r"/(TRTP|CSID|NAME|MARF|REMI|IBAN|BIC|EREF)/")
 
-qif_tpl_plain_tsx = """!Type:{type}
-D{date}
-T{amount}
-C
-P{payee}
-M{memo}
-L{ledger}
-^"""
+ABN_re = re.compile(r"(?P<payee>ABN AMRO Bank N\.V\.)\s+(?P<memo>\w+)")
 
+SPAREN_re = re.compile(r"ACCOUNT BALANCED\s+(?P<memo>CREDIT INTEREST.+)For interest rates")
+
+STORTING_re = re.compile(r"STORTING\s+.+?,PAS \d+")
+
+SUPPORTED_TRANSACTIONS = (
+    ('bea', BEA_re),
+    ('sepa', SEPA_re),
+    ('abn', ABN_re),
+    ('sparen', SPAREN_re),
+    ('storting', STORTING_re),
+)
 
-class Trsx:
-    def __init__(self, account_iban):
-        self.source_iban = account_iban
-        self.dest_iban = None
-        self.type = None
-        self.date = None
-        self.amount = None
-        self.payee = None
-        self.memo = None
-        self.transaction_desc = None
-
-    def __eq__(self, other):
-        if type(other) == Trsx:
-            return self.source_iban == other.source_iban \
-                   and self.dest_iban == other.dest_iban \
-                   and self.type == other.type \
-                   and self.date == other.date \
-                   and self.amount == other.amount \
-                   and self.payee == other.payee \
-                   and self.memo == other.memo \
-                   # and self.transaction_desc == other.transaction_desc
-        else:
-            return False
-
-    def __hash__(self):
-        return hash("%s-%s-%s-%s/%s" %
-                    (self.source_iban,
-                     self.dest_iban,
-                     self.date.strftime("%Y%m%d"),
-                     str(self.amount),
-                     self.memo))
-
-    def __str__(self):
-        return "{dt}: {src} -> {dst} {amt} ({pay}: {memo})".format(dt=self.date.strftime("%d/%m/%Y"),
-                                                                   src=self.source_iban,
-                                                                   dst=self.dest_iban,
-                                                                   amt=self.amount,
-                                                                   pay=self.payee,
-                                                                   memo=self.memo)
-
-    def is_transfer_transaction(self):
-        return self.dest_iban in accounts
-
-    def complementary(self):
-        if not self.is_transfer_transaction():
-            raise ValueError("Complementary Trsx available only for transfer transactions")
-
-        compl = Trsx(self.dest_iban)
-        compl.dest_iban = self.source_iban
-        compl.type = self.type
-        compl.date = self.date
-        compl.amount = self.amount * -1
-        compl.payee = self.payee
-        compl.memo = self.memo
-        compl.transaction_desc = self.transaction_desc
-        return compl
-
-    def get_qif_tx(self):
-        def nn(v):
-            return v if v else ''
-
-        var = {
-            'type': self.type,
-            'date': self.date.strftime("%Y/%m/%d"),
-            'amount': self.amount,
-            'payee': nn(self.payee),
-            'memo': nn(self.memo),
-            'ledger': '',
-        }
-
-        if self.is_transfer_transaction():
-            if self.memo is None:
-                var['memo'] = 'Transfer'
-
-            var['ledger'] = '[%s]' % _get_account(self.dest_iban)
-
-        return qif_tpl_plain_tsx.format(**var)
-
-
-def _get_account(iban):
-    return accounts[iban]
-
-
-def process_entry(account_iban, elem):
-    def find_sepa_field(field):
-        if SEPA_re.search(transaction_info):
-            start = None
-            for marker_match in SEPA_markers_re.finditer(transaction_info):
-                if marker_match.group(1) == field:
-                    start = marker_match.end(0)
-                elif start:
-                    return transaction_info[start:marker_match.start(0)]
-
-        return None
-
-    def _get_regex():
-        for _type, regexp in SUPPORTED_TRANSACTIONS.items():
-            _match = regexp.search(transaction_info)
-            if _match:
-                return _type, _match
-
-        return None, None
 
+class Trsx:
+    __slots__ = ('source_iban', 'dest_iban', 'type', 'amount', 'payee', 'memo', 'transaction_desc',
+                 '_datekey', '_ledger', '_flipped_ledger')
+
+    def __init__(self, account_iban: str):
+        self.source_iban: str = account_iban
+        self.dest_iban: Optional[str] = None
+        self.type: Optional[str] = None
+        self.amount = 0.0
+        self.payee: Optional[str] = None
+        self.memo: Optional[str] = None
+        self.transaction_desc: Optional[str] = None
+        self._datekey = ''
+        self._ledger = ''
+        self._flipped_ledger = ''
+
+    def set_date(self, iso_date: str) -> None:
+        # CAMT dates are always YYYY-MM-DD: keep them as YYYYMMDD, the only form keys and QIF entries need
+        self._datekey = iso_date.replace('-', '')
+
+    def set_ledgers(self, accounts: Dict[str, str]) -> None:
+        # QIF ledgers of both orientations, computed once instead of at every rendering
+        if self.dest_iban in accounts:
+            self._ledger = '[%s]' % accounts[self.dest_iban]
+            if self.source_iban in accounts:
+                self._flipped_ledger = '[%s]' % accounts[self.source_iban]
+
+    def oriented(self, flipped: bool = False) -> Tuple[str, Optional[str], float]:
+        # a flipped transaction is the same transfer seen from the destination account
+        if flipped:
+            assert self.dest_iban is not None, "Only transfer transactions can be flipped"
+            return self.dest_iban, self.source_iban, self.amount * -1
+        return self.source_iban, self.dest_iban, self.amount
+
+    def key(self, flipped: bool = False) -> TrsxKey:
+        source_iban, dest_iban, amount = self.oriented(flipped)
+        return source_iban, dest_iban, self.type, self._datekey, amount, self.payee, self.memo
+
+    def is_transfer_transaction(self) -> bool:
+        return bool(self._ledger)
+
+    def get_qif_tx(self, flipped: bool = False) -> str:
+        _, _, amount = self.oriented(flipped)
+        ledger = self._flipped_ledger if flipped else self._ledger
+        memo = self.memo or ''
+
+        if ledger and self.memo is None:
+            memo = 'Transfer'
+
+        datekey = self._datekey
+        return (f"!Type:{self.type}\n"
+                f"D{datekey[0:4]}/{datekey[4:6]}/{datekey[6:8]}\n"
+                f"T{amount}\n"
+                f"C\n"
+                f"P{self.payee or ''}\n"
+                f"M{memo}\n"
+                f"L{ledger}\n"
+                f"^")
+
+
+def _describe_key(key: TrsxKey) -> str:
+    source_iban, dest_iban, _, datekey, amount, payee, memo = key
+    return "{dt}: {src} -> {dst} {amt} ({pay}: {memo})".format(dt="%s/%s/%s" % (datekey[6:8],
+                                                                                datekey[4:6],
+                                                                                datekey[0:4]),
+                                                               src=source_iban,
+                                                               dst=dest_iban,
+                                                               amt=amount,
+                                                               pay=payee,
+                                                               memo=memo)
+
+
+def _sepa_fields(transaction_info: str) -> Dict[str, str]:
+    markers = list(SEPA_markers_re.finditer(transaction_info))
+    fields: Dict[str, str] = {}
+    for marker, next_marker in zip(markers, markers[1:]):
+        fields.setdefault(marker.group(1), transaction_info[marker.end(0):next_marker.start(0)])
+
+    return fields
+
+
+def _match_transaction(transaction_info: str) -> Tuple[str, Match[str]]:
+    # the patterns are tried in order, the first one found anywhere in the description wins
+    for tx_type, regexp in SUPPORTED_TRANSACTIONS:
+        match = regexp.search(transaction_info)
+        if match:
+            return tx_type, match
+
+    raise ValueError('Transaction type not supported for "%s"' % transaction_info)
+
+
+def _entry_fields(account_iban: str, elem: ET._Element) -> RawEntry:
+    return (account_iban,
+            elem.find(VALDT_path).text,
+            elem.find(AMT_path).text,
+            elem.find(CDTDBTIND_path).text,
+            elem.find(ADDTLNTRYINF_path).text)
+
+
+def process_entry(account_iban: str, value_date: str, amount: str, credit_debit: str, transaction_info: str,
+                  accounts: Dict[str, str]) -> Trsx:
     tsx = Trsx(account_iban)
 
-    tsx.date = datetime.datetime.strptime(elem.find("xmlns:ValDt/xmlns:Dt", namespaces=ns).text, "%Y-%m-%d")
-    tsx.amount = float(elem.find("xmlns:Amt", namespaces=ns).text)
-    if elem.find("xmlns:CdtDbtInd", namespaces=ns).text == 'DBIT':
+    tsx.set_date(value_date)
+    tsx.amount = float(amount)
+    if credit_debit == 'DBIT':
         tsx.amount *= -1
 
-    transaction_info = elem.find("xmlns:AddtlNtryInf", namespaces=ns).text
     tsx.transaction_desc = transaction_info
 
-    tx_type, match = _get_regex()
-
+    tx_type, match = _match_transaction(transaction_info)
     if tx_type == 'bea':
         tsx.type = 'Bank' if match.group("subtype") == 'B' else 'Cash'
         tsx.payee = match.group("payee")
         tsx.memo = transaction_info
 
     elif tx_type == 'sepa':
+        fields = _sepa_fields(transaction_info)
         tsx.type = 'Bank'
-        tsx.payee = find_sepa_field('NAME')
-        tsx.memo = find_sepa_field("REMI")
-        tsx.dest_iban = find_sepa_field('IBAN')
+        tsx.payee = fields.get('NAME')
+        tsx.memo = fields.get('REMI')
+        tsx.dest_iban = fields.get('IBAN')
+        tsx.set_ledgers(accounts)
 
     elif tx_type == 'abn':
         tsx.type = 'Bank'
@@ -187,96 +188,114 @@ def process_entry(account_iban, elem):
         tsx.payee = 'Unknwon'
         tsx.memo = None
 
-    else:
-        raise ValueError('Transaction type not supported for "%s"' % transaction_info)
-
     return tsx
 
 
-def _qif_account(account_name, account_type):
-    return qif_account_tpl.format(name=account_name, type=account_type)
-
+def _qif_account(account_name: str, account_type: str) -> str:
+    return f"!Account\nN{account_name}\nT{account_type}\n^"
 
-def _trsx_list(file):
-    xml_parser = xml.etree.ElementTree.XMLParser(encoding='cp1252')
 
-    def n(name):
-        return "{urn:iso:std:iso:20022:tech:xsd:camt.053.001.02}" + name
+def _is_xml(file_name: str) -> bool:
+    return file_name.lower().endswith('.xml')
 
-    if file[-3:] == 'xml':
-        tree = xml.etree.ElementTree.parse(file, xml_parser)
 
-        account_iban = tree.find('xmlns:BkToCstmrStmt/xmlns:Stmt/xmlns:Acct/xmlns:Id/xmlns:IBAN', namespaces=ns).text
-        for elem in tree.iter(tag=n("Ntry")):
-            trsx = process_entry(account_iban, elem)
-            if trsx:
-                yield trsx
-                if trsx.is_transfer_transaction():
-                    yield trsx.complementary()
+def _entry_list(file_name: str, file: IO[bytes]) -> Iterator[RawEntry]:
+    if _is_xml(file_name):
+        account_iban = ''
+        context = ET.iterparse(file, events=("end",), tag=(IBAN_tag, NTRY_tag), encoding='cp1252')
+        for _, elem in context:
+            if elem.tag == NTRY_tag:
+                yield _entry_fields(account_iban, elem)
+                # drop the entry and the already parsed siblings to keep memory bounded
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+            elif not account_iban:
+                # the statement account comes before any entry
+                account_iban = elem.text
     else:
         raise ValueError('Only CAM.53 XML files are supported')
 
 
-def _all_files():
-    for source in args.source:
-        if zipfile.is_zipfile(source):
-            tmp_dir = tempfile.mkdtemp(prefix="abnconv_")
+def _all_files(sources: List[str], prune: bool) -> Iterator[Tuple[str, IO[bytes]]]:
+    for source in sources:
+        if _is_xml(source) and os.path.isfile(source):
+            with open(source, 'rb', buffering=BUFFER_SIZE) as source_file:
+                yield source, source_file
+            if prune:
+                os.remove(source)
+        elif zipfile.is_zipfile(source):
+            # members are parsed straight from the archive, no extraction to disk
             with zipfile.ZipFile(source, 'r') as zf:
-                zf.extractall(tmp_dir)
-
-            for _file in [os.path.join(tmp_dir, f) for f in os.listdir(tmp_dir)]:
-                yield _file
+                for member in zf.infolist():
+                    if not member.is_dir():
+                        with io.BufferedReader(cast(io.RawIOBase, zf.open(member)), buffer_size=BUFFER_SIZE) as member_file:
+                            yield member.filename, member_file
 
-            shutil.rmtree(tmp_dir)
-            if args.prune:
-                os.remove(source)
-        elif os.path.isfile(source) and source[-3:] == 'xml':
-            yield source
-            if args.prune:
+            if prune:
                 os.remove(source)
 
 
 class QIFOutput:
-    def __init__(self, output_path):
+    def __init__(self, output_path: str, account_names: Dict[str, str], verbose: bool = False):
         self.output_path = output_path
-        self.output_file = None
-        self.accounts = {}
-        self._transaction_list = set()
+        self.account_names = account_names
+        self.verbose = verbose
+        self.output_fd: int = -1
+        self.accounts: Dict[str, List[str]] = {}
+        self._transaction_list: Set[TrsxKey] = set()
         self.added = 0
         self.skipped = 0
 
-    def __enter__(self):
-        self.output_file = open(self.output_path, 'w')
+    def __enter__(self) -> 'QIFOutput':
+        self.output_fd = os.open(self.output_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
         return self
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        for qif_entry_list in self.accounts.values():
-            for qif_entry in qif_entry_list:
-                print(qif_entry, file=self.output_file)
-
-        self.output_file.close()
+    def __exit__(self, exc_type: Optional[Type[BaseException]], exc_val: Optional[BaseException],
+                 exc_tb: Optional[TracebackType]) -> None:
+        qif_entries = [qif_entry for qif_entry_list in self.accounts.values() for qif_entry in qif_entry_list]
+        payload = ('\n'.join(qif_entries) + '\n').encode('utf-8') if qif_entries else b''
+
+        try:
+            # os.write may write less than asked for
+            written = 0
+            while written < len(payload):
+                written += os.write(self.output_fd, payload[written:])
+        finally:
+            os.close(self.output_fd)
+
+    def __iadd__(self, transaction: Union[Trsx, Tuple[Trsx, bool]]) -> 'QIFOutput':
+        # transfers are also added as (transaction, True), to be recorded on the destination account
+        if isinstance(transaction, tuple):
+            transaction, flipped = transaction
+        else:
+            flipped = False
 
-    def __iadd__(self, transaction: Trsx):
-        if transaction not in self._transaction_list:
-            self._get_list(transaction.source_iban).append(transaction.get_qif_tx())
-            self._transaction_list.add(transaction)
+        key = transaction.key(flipped)
+        if key not in self._transaction_list:
+            self._get_list(key[0]).append(transaction.get_qif_tx(flipped))
+            self._transaction_list.add(key)
             self.added += 1
         else:
-            if args.verbose:
-                print("Found duplicated transaction: %s" % transaction)
-            self.skipped += 1
+            self.report_duplicates((key,))
 
         return self
 
-    def _get_list(self, account):
+    def report_duplicates(self, keys: Tuple[TrsxKey, ...]) -> None:
+        for key in keys:
+            if self.verbose:
+                print("Found duplicated transaction: %s" % _describe_key(key))
+            self.skipped += 1
+
+    def _get_list(self, account: str) -> List[str]:
         if account not in self.accounts:
             self.accounts[account] = list()
-            self.accounts[account].append(qif_account_tpl.format(name=_get_account(account), type='Bank'))
+            self.accounts[account].append(_qif_account(self.account_names[account], 'Bank'))
         return self.accounts[account]
 
 
-def _load_accounts():
-    _accounts = {}
+def _load_accounts(conf_parser: configparser.ConfigParser) -> Dict[str, str]:
+    _accounts: Dict[str, str] = {}
     for account_conf in [conf_parser[section] for section in conf_parser.sections()]:
         _acc_iban = account_conf['iban']
         _accounts[_acc_iban] = account_conf['name'] if 'name' in account_conf else _acc_iban
@@ -284,7 +303,26 @@ def _load_accounts():
     return _accounts
 
 
-if __name__ == '__main__':
+def convert(sources: Iterable[Tuple[str, IO[bytes]]], accounts: Dict[str, str], out: QIFOutput) -> None:
+    seen_entries: Dict[RawEntry, Tuple[TrsxKey, ...]] = {}
+    for source_name, source_file in sources:
+        for entry in _entry_list(source_name, source_file):
+            # identical raw entries always give the same transactions: only their keys are kept, to report
+            # them as duplicated without processing the entry again
+            keys = seen_entries.get(entry)
+            if keys is None:
+                trsx = process_entry(*entry, accounts)
+                out += trsx
+                keys = (trsx.key(),)
+                if trsx.is_transfer_transaction():
+                    out += (trsx, True)
+                    keys += (trsx.key(True),)
+                seen_entries[entry] = keys
+            else:
+                out.report_duplicates(keys)
+
+
+def main() -> None:
     parser = argparse.ArgumentParser()
     parser.add_argument("config", help="INI Configuration file")
     parser.add_argument("source", nargs="+", help="ABN AMRO CAMT export file")
@@ -298,13 +336,11 @@ if __name__ == '__main__':
     conf_parser = configparser.ConfigParser()
     conf_parser.read(args.config)
 
-    accounts = _load_accounts()
+    accounts = _load_accounts(conf_parser)
 
     out_path = args.output if args.output else args.source[0] + '.qif'
-    with QIFOutput(out_path) as out:
-        for source_file in _all_files():
-            for _trsx in _trsx_list(source_file):
-                out += _trsx
+    with QIFOutput(out_path, accounts, verbose=args.verbose) as out:
+        convert(_all_files(args.source, args.prune), accounts, out)
 
     print("""
 Process completed:
@@ -313,3 +349,7 @@ Process completed:
     and {dup} transactions reported as duplicated""".format(inserted=out.added,
                                                             accounts=len(out.accounts),
                                                             dup=out.skipped))
+
+
+if __name__ == '__main__':
+    main()
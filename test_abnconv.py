@@ -0,0 +1,145 @@
+import contextlib
+import io
+import os
+import tempfile
+import unittest
+
+import abnconv
+
+MAIN = 'NL95ABNA1234567890'
+SAVINGS = 'NL84ABNA0987654321'
+
+ACCOUNTS = {MAIN: 'Main account'}
+
+BEA = ('2020-01-02', '12.50', 'DBIT', 'BEA   NR:XXXX   02.01.20/12.34 Albert Heijn 1234,PAS123')
+TO_SAVINGS = ('2020-01-03', '100.00', 'DBIT',
+              '/TRTP/SEPA OVERBOEKING/IBAN/%s/BIC/ABNANL2A/NAME/J DOE/REMI/saving/EREF/NOTPROVIDED' % SAVINGS)
+FROM_MAIN = ('2020-01-03', '100.00', 'CRDT',
+             '/TRTP/SEPA OVERBOEKING/IBAN/%s/BIC/ABNANL2A/NAME/J DOE/REMI/saving/EREF/NOTPROVIDED' % MAIN)
+
+
+def _statement(iban, entries):
+    body = "".join("<Ntry><Amt Ccy='EUR'>%s</Amt><CdtDbtInd>%s</CdtDbtInd><ValDt><Dt>%s</Dt></ValDt>"
+                   "<AddtlNtryInf>%s</AddtlNtryInf></Ntry>" % (amount, credit_debit, value_date, info)
+                   for value_date, amount, credit_debit, info in entries)
+    xml = ("<?xml version='1.0' encoding='UTF-8'?>"
+           "<Document xmlns='urn:iso:std:iso:20022:tech:xsd:camt.053.001.02'><BkToCstmrStmt><Stmt>"
+           "<Acct><Id><IBAN>%s</IBAN></Id></Acct>%s</Stmt></BkToCstmrStmt></Document>" % (iban, body))
+    return io.BytesIO(xml.encode('cp1252'))
+
+
+def _process(transaction_info):
+    return abnconv.process_entry('NL95ABNA1234567890', '2019-01-03', '12.50', 'DBIT', transaction_info, ACCOUNTS)
+
+
+class ProcessEntryTest(unittest.TestCase):
+    def test_bea(self):
+        tsx = _process("BEA   NR:XXXX   02.01.20/12.34 Albert Heijn 1234,PAS123")
+        self.assertEqual(tsx.type, 'Bank')
+        self.assertEqual(tsx.payee, ' Albert Heijn 1234')
+
+    def test_gea_terminal_ending_in_digits(self):
+        tsx = _process("GEA   NR:00AH5768 03.01.19/14.07 ING Amsterdam,PAS123")
+        self.assertEqual(tsx.type, 'Cash')
+        self.assertEqual(tsx.payee, ' ING Amsterdam')
+
+    def test_bea_after_leading_text(self):
+        tsx = _process("  BEA   NR:XXXX   02.01.20/12.34 Albert Heijn 1234,PAS123")
+        self.assertEqual(tsx.payee, ' Albert Heijn 1234')
+
+    def test_abn_after_leading_text(self):
+        tsx = _process(" ABN AMRO Bank N.V.  Basic     package fees")
+        self.assertEqual(tsx.payee, 'ABN AMRO Bank N.V.')
+        self.assertEqual(tsx.memo, 'Basic')
+
+    def test_bea_before_sepa(self):
+        tsx = _process("/TRTP/SEPA OVERBOEKING/IBAN/NL84ABNA0987654321/BIC/ABNANL2A/NAME/J DOE"
+                       "/REMI/BEA   NR:XXXX   02.01.20/12.34 Albert Heijn 1234,PAS123/EREF/NOTPROVIDED")
+        self.assertEqual(tsx.payee, ' Albert Heijn 1234')
+        self.assertIsNone(tsx.dest_iban)
+
+    def test_sepa(self):
+        tsx = _process("/TRTP/SEPA OVERBOEKING/IBAN/NL84ABNA0987654321/BIC/ABNANL2A/NAME/J DOE/REMI/saving"
+                       "/EREF/NOTPROVIDED")
+        self.assertEqual(tsx.payee, 'J DOE')
+        self.assertEqual(tsx.memo, 'saving')
+        self.assertEqual(tsx.dest_iban, 'NL84ABNA0987654321')
+
+    def test_trailing_sepa_marker(self):
+        with self.assertRaises(ValueError):
+            _process("some text /TRTP/")
+
+
+class FlippedTransferTest(unittest.TestCase):
+    accounts = {MAIN: 'Main account', SAVINGS: 'Savings'}
+
+    def _transfer(self, transaction_info=TO_SAVINGS[3]):
+        return abnconv.process_entry(MAIN, TO_SAVINGS[0], TO_SAVINGS[1], TO_SAVINGS[2], transaction_info,
+                                     self.accounts)
+
+    def test_key(self):
+        tsx = self._transfer()
+        self.assertEqual(tsx.key(), (MAIN, SAVINGS, 'Bank', '20200103', -100.0, 'J DOE', 'saving'))
+        self.assertEqual(tsx.key(True), (SAVINGS, MAIN, 'Bank', '20200103', 100.0, 'J DOE', 'saving'))
+
+    def test_qif(self):
+        tsx = self._transfer()
+        self.assertEqual(tsx.get_qif_tx(True),
+                         "!Type:Bank\nD2020/01/03\nT100.0\nC\nPJ DOE\nMsaving\nL[Main account]\n^")
+
+    def test_qif_without_memo(self):
+        tsx = self._transfer("/TRTP/SEPA OVERBOEKING/IBAN/%s/BIC/ABNANL2A/NAME/J DOE/EREF/NOTPROVIDED" % SAVINGS)
+        self.assertEqual(tsx.get_qif_tx(),
+                         "!Type:Bank\nD2020/01/03\nT-100.0\nC\nPJ DOE\nMTransfer\nL[Savings]\n^")
+        self.assertEqual(tsx.get_qif_tx(True),
+                         "!Type:Bank\nD2020/01/03\nT100.0\nC\nPJ DOE\nMTransfer\nL[Main account]\n^")
+
+
+class ConvertTest(unittest.TestCase):
+    accounts = {MAIN: 'Main account', SAVINGS: 'Savings'}
+
+    def _convert(self, *statements):
+        fd, path = tempfile.mkstemp(suffix='.qif')
+        os.close(fd)
+        self.addCleanup(os.remove, path)
+
+        stdout = io.StringIO()
+        with contextlib.redirect_stdout(stdout):
+            with abnconv.QIFOutput(path, self.accounts, verbose=True) as out:
+                sources = [('statement_%d.xml' % i, statement) for i, statement in enumerate(statements)]
+                abnconv.convert(sources, self.accounts, out)
+
+        with open(path) as qif_file:
+            return out, stdout.getvalue().splitlines(), qif_file.read()
+
+    def test_repeated_entries(self):
+        out, lines, _ = self._convert(_statement(MAIN, [BEA, TO_SAVINGS, BEA, TO_SAVINGS]))
+        self.assertEqual(out.added, 3)
+        self.assertEqual(out.skipped, 3)
+        self.assertEqual(lines, [
+            "Found duplicated transaction: 02/01/2020: NL95ABNA1234567890 -> None -12.5 "
+            "( Albert Heijn 1234: BEA   NR:XXXX   02.01.20/12.34 Albert Heijn 1234,PAS123)",
+            "Found duplicated transaction: 03/01/2020: NL95ABNA1234567890 -> NL84ABNA0987654321 -100.0 "
+            "(J DOE: saving)",
+            "Found duplicated transaction: 03/01/2020: NL84ABNA0987654321 -> NL95ABNA1234567890 100.0 "
+            "(J DOE: saving)",
+        ])
+
+    def test_transfer_from_both_statements(self):
+        out, lines, qif = self._convert(_statement(MAIN, [TO_SAVINGS]), _statement(SAVINGS, [FROM_MAIN]))
+        self.assertEqual(out.added, 2)
+        self.assertEqual(out.skipped, 2)
+        self.assertEqual(lines, [
+            "Found duplicated transaction: 03/01/2020: NL84ABNA0987654321 -> NL95ABNA1234567890 100.0 "
+            "(J DOE: saving)",
+            "Found duplicated transaction: 03/01/2020: NL95ABNA1234567890 -> NL84ABNA0987654321 -100.0 "
+            "(J DOE: saving)",
+        ])
+        self.assertEqual(qif, "!Account\nNMain account\nTBank\n^\n"
+                              "!Type:Bank\nD2020/01/03\nT-100.0\nC\nPJ DOE\nMsaving\nL[Savings]\n^\n"
+                              "!Account\nNSavings\nTBank\n^\n"
+                              "!Type:Bank\nD2020/01/03\nT100.0\nC\nPJ DOE\nMsaving\nL[Main account]\n^\n")
+
+
+if __name__ == '__main__':
+    unittest.main()